@@ -52,7 +52,7 @@ String inputString = "";
 bool stringComplete = false;
 
 void setup() {
-  Serial.begin(9600);
+  Serial.begin(115200);
   while (!Serial) {}
 
   for (int i = 0; i < 4; i++) {
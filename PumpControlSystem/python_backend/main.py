@@ -1,10 +1,21 @@
 #!/usr/bin/env python3
 # Flask web server that serves the frontend and provides API endpoints for communicating with Arduino via serial connection
+# The Flask app is exposed as an ASGI application and served by Uvicorn
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify
 from flask_cors import CORS
+from flask_orjson import OrjsonProvider
+from a2wsgi import WSGIMiddleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.exceptions import ExceptionMiddleware
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+import uvicorn
 import os
-import json
+from typing import Union
+import hashlib
+import orjson
+import msgspec
 import logging
 from serial_handler import SerialHandler
 
@@ -14,6 +25,7 @@ logger = logging.getLogger(__name__)
 
 # Initialize Flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)  # Use orjson for jsonify/get_json
 CORS(app)  # Enable CORS for all routes
 
 # Initialize serial handler
@@ -21,88 +33,120 @@ serial_handler = SerialHandler()
 
 # Configuration
 FRONTEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'frontend')
+INDEX_PATH = os.path.join(FRONTEND_DIR, 'index.html')
 DEFAULT_PORT = 5000
+WSGI_WORKERS = 10  # Flask requests served concurrently
 
-@app.route('/')
-def index():
-    # Serve the main HTML page
+def load_index():
+    # Read index.html once at import time; changes need a server restart
     try:
-        return send_from_directory(FRONTEND_DIR, 'index.html')
+        with open(INDEX_PATH, 'rb') as index_file:
+            return index_file.read()
     except FileNotFoundError:
-        return "Frontend files not found. Please ensure index.html is in the frontend directory.", 404
+        return None
 
-@app.route('/<path:filename>')
-def serve_static(filename):
-    # Serve static files (CSS, JS, images)
-    try:
-        return send_from_directory(FRONTEND_DIR, filename)
-    except FileNotFoundError:
-        return f"File {filename} not found.", 404
+INDEX_BYTES = load_index()
+INDEX_ETAG = hashlib.md5(INDEX_BYTES).hexdigest() if INDEX_BYTES is not None else None
+
+# Request validation
+VALID_PUMPS = frozenset(('X', 'Y', 'Z', 'A'))
+RPM_MAX = 2000.0
+
+# Numeric fields take whatever float()/int() accept: numbers, booleans and numeric strings
+NumberField = Union[int, float, bool, str, msgspec.UnsetType]
+
+class StartPumpRequest(msgspec.Struct):
+    # Body of /api/start_pump; decoding and validation happen in a single pass.
+    # Fields default to UNSET so every missing one can be reported at once.
+    pump: Union[str, msgspec.UnsetType] = msgspec.UNSET
+    rpm: NumberField = msgspec.UNSET
+    time: NumberField = msgspec.UNSET
+    continuous: NumberField = msgspec.UNSET
+
+    def __post_init__(self):
+        missing = sorted(f for f in self.__struct_fields__ if getattr(self, f) is msgspec.UNSET)
+        if missing:
+            raise ValueError(f'Missing required field: {", ".join(missing)}')
+        
+        try:
+            self.rpm = float(self.rpm)
+            self.time = int(self.time)
+            self.continuous = int(self.continuous)
+        except ValueError as e:
+            raise ValueError(f'Invalid parameter value: {e}') from e
+        
+        self.pump = self.pump.upper()
+        if self.pump not in VALID_PUMPS:
+            raise ValueError('Invalid pump identifier.')
+        if abs(self.rpm) > RPM_MAX:
+            raise ValueError(f'RPM must be between -{RPM_MAX:g} and {RPM_MAX:g}.')
+        if self.continuous == 0 and self.time <= 0:
+            raise ValueError('Time must be positive for non-continuous operation.')
+
+START_PUMP_DECODER = msgspec.json.Decoder(StartPumpRequest)
+
+# Pre-serialized bodies for error responses whose message never changes
+INVALID_PUMP_BODY = orjson.dumps({'success': False, 'message': 'Invalid pump identifier.'})
+MISSING_PUMP_BODY = orjson.dumps({'success': False, 'message': 'Missing required field: pump'})
+INVALID_STATUS_BODY = orjson.dumps({'success': False, 'message': 'Invalid status response from Arduino'})
+NOT_FOUND_BODY = orjson.dumps({'success': False, 'message': 'Endpoint not found'})
+INTERNAL_ERROR_BODY = orjson.dumps({'success': False, 'message': 'Internal server error'})
+
+def static_json_response(body, status):
+    # Wrap a pre-serialized JSON body. A fresh Response is still built per request
+    # because after_request hooks (CORS) add headers to the response object.
+    return app.response_class(body, status=status, mimetype='application/json')
+
+@app.route('/')
+def index():
+    # Serve the main HTML page from memory, answering 304 when the client's copy is current
+    if INDEX_BYTES is None:
+        return "Frontend files not found. Please ensure index.html is in the frontend directory.", 404
+    
+    if request.if_none_match.contains(INDEX_ETAG):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(INDEX_BYTES, mimetype='text/html')
+    response.set_etag(INDEX_ETAG)
+    return response
 
 @app.route('/api/start_pump', methods=['POST'])
 def start_pump():
     # Start a specific pump with given parameters
     try:
-        data = request.get_json()
-        # Validate required fields
-        required_fields = ['pump', 'rpm', 'time', 'continuous']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({
-                    'success': False,
-                    'message': f'Missing required field: {field}'
-                }), 400
-        
-        pump = data['pump'].upper()
-        rpm = float(data['rpm'])
-        time = int(data['time'])
-        continuous = int(data['continuous'])
-        
-        # Validate pump identifier
-        if pump not in ['X', 'Y', 'Z', 'A']:
-            return jsonify({
-                'success': False,
-                'message': 'Invalid pump identifier.'
-            }), 400
-        
-        # Validate RPM
-        if abs(rpm) > 2000:
+        # Decode and validate the request body
+        try:
+            params = START_PUMP_DECODER.decode(request.get_data(cache=False) or b'{}')
+        except msgspec.DecodeError as e:
+            # Errors raised in __post_init__ already carry the message for the UI;
+            # malformed JSON and wrong types come from msgspec itself
+            message = str(e.__cause__) if e.__cause__ is not None else f'Invalid parameter value: {e}'
             return jsonify({
                 'success': False,
-                'message': 'RPM must be between -2000 and 2000.'
+                'message': message
             }), 400
         
-        # Validate time for non-continuous operation
-        if continuous == 0 and time <= 0:
-            return jsonify({
-                'success': False,
-                'message': 'Time must be positive for non-continuous operation.'
-            }), 400
+        pump, rpm, time, continuous = params.pump, params.rpm, params.time, params.continuous
         
         # Send command to Arduino
         command = f"START,{pump},{rpm},{time},{continuous}"
         response = serial_handler.send_command(command)
         
         if response == "OK":
-            logger.info(f"Started pump {pump} at {rpm} RPM")
+            logger.info("Started pump %s at %s RPM", pump, rpm)
             return jsonify({
                 'success': True,
                 'message': f'Pump {pump} started successfully'
             })
         else:
-            logger.error(f"Arduino error starting pump {pump}: {response}")
+            logger.error("Arduino error starting pump %s: %s", pump, response)
             return jsonify({
                 'success': False,
                 'message': f'Arduino error: {response}'
             }), 500
             
-    except ValueError as e:
-        return jsonify({
-            'success': False,
-            'message': f'Invalid parameter value: {str(e)}'
-        }), 400
     except Exception as e:
-        logger.error(f"Error starting pump: {str(e)}")
+        logger.error("Error starting pump: %s", e)
         return jsonify({
             'success': False,
             'message': f'Internal error: {str(e)}'
@@ -112,40 +156,35 @@ def start_pump():
 def stop_pump():
     # Stop a specific pump
     try:
-        data = request.get_json()
+        raw = request.get_data(cache=False)
+        data = orjson.loads(raw) if raw else {}
         if 'pump' not in data:
-            return jsonify({
-                'success': False,
-                'message': 'Missing required field: pump'
-            }), 400
+            return static_json_response(MISSING_PUMP_BODY, 400)
         pump = data['pump'].upper()
         
         # Validate pump identifier
-        if pump not in ['X', 'Y', 'Z', 'A']:
-            return jsonify({
-                'success': False,
-                'message': 'Invalid pump identifier.'
-            }), 400
+        if pump not in VALID_PUMPS:
+            return static_json_response(INVALID_PUMP_BODY, 400)
         
         # Send command to Arduino
         command = f"STOP,{pump}"
         response = serial_handler.send_command(command)
         
         if response == "OK":
-            logger.info(f"Stopped pump {pump}")
+            logger.info("Stopped pump %s", pump)
             return jsonify({
                 'success': True,
                 'message': f'Pump {pump} stopped successfully'
             })
         else:
-            logger.error(f"Arduino error stopping pump {pump}: {response}")
+            logger.error("Arduino error stopping pump %s: %s", pump, response)
             return jsonify({
                 'success': False,
                 'message': f'Arduino error: {response}'
             }), 500
             
     except Exception as e:
-        logger.error(f"Error stopping pump: {str(e)}")
+        logger.error("Error stopping pump: %s", e)
         return jsonify({
             'success': False,
             'message': f'Internal error: {str(e)}'
@@ -156,7 +195,7 @@ def emergency_stop():
     # Emergency stop - stop all pumps immediately
     try:
         # Send emergency command to Arduino
-        response = serial_handler.send_command("EMERGENCY")
+        response = serial_handler.send_command("EMERGENCY", preempt=True)
         
         if response == "OK":
             logger.warning("Emergency stop activated")
@@ -165,14 +204,14 @@ def emergency_stop():
                 'message': 'Emergency stop activated, All pumps stopped'
             })
         else:
-            logger.error(f"Arduino error during emergency stop: {response}")
+            logger.error("Arduino error during emergency stop: %s", response)
             return jsonify({
                 'success': False,
                 'message': f'Arduino error: {response}'
             }), 500
             
     except Exception as e:
-        logger.error(f"Error during emergency stop: {str(e)}")
+        logger.error("Error during emergency stop: %s", e)
         return jsonify({
             'success': False,
             'message': f'Internal error: {str(e)}'
@@ -183,32 +222,35 @@ def get_status():
     # Get current status of all pumps
     try:
         # Request status from Arduino
-        response = serial_handler.send_command("STATUS")
+        response = serial_handler.get_status()
         
-        if response.startswith('{') and response.endswith('}'):
-            # Parse JSON response from Arduino
-            try:
-                status_data = json.loads(response)
-                return jsonify({
-                    'success': True,
-                    'status': status_data,
-                    'message': 'Status retrieved successfully'
-                })
-            except json.JSONDecodeError:
-                logger.error(f"Invalid JSON response from Arduino: {response}")
+        # Parse JSON response from Arduino; anything else fails to decode
+        try:
+            status_data = orjson.loads(response)
+        except orjson.JSONDecodeError:
+            if response.startswith('ERROR'):
+                logger.error("Unexpected status response from Arduino: %s", response)
                 return jsonify({
                     'success': False,
-                    'message': 'Invalid status response from Arduino'
+                    'message': f'Arduino error: {response}'
                 }), 500
-        else:
-            logger.error(f"Unexpected status response from Arduino: {response}")
-            return jsonify({
-                'success': False,
-                'message': f'Arduino error: {response}'
-            }), 500
+            
+            logger.error("Invalid JSON response from Arduino: %s", response)
+            return static_json_response(INVALID_STATUS_BODY, 500)
+        
+        # orjson also accepts scalars and arrays, but a status reply is always an object
+        if not isinstance(status_data, dict):
+            logger.error("Invalid JSON response from Arduino: %s", response)
+            return static_json_response(INVALID_STATUS_BODY, 500)
+        
+        return jsonify({
+            'success': True,
+            'status': status_data,
+            'message': 'Status retrieved successfully'
+        })
             
     except Exception as e:
-        logger.error(f"Error getting status: {str(e)}")
+        logger.error("Error getting status: %s", e)
         return jsonify({
             'success': False,
             'message': f'Internal error: {str(e)}'
@@ -226,7 +268,7 @@ def connection_status():
             'message': 'Connected' if is_connected else 'Disconnected'
         })
     except Exception as e:
-        logger.error(f"Error checking connection status: {str(e)}")
+        logger.error("Error checking connection status: %s", e)
         return jsonify({
             'success': False,
             'connected': False,
@@ -236,18 +278,44 @@ def connection_status():
 @app.errorhandler(404)
 def not_found(error):
     # Handle 404 errors 
-    return jsonify({
-        'success': False,
-        'message': 'Endpoint not found'
-    }), 404
+    return static_json_response(NOT_FOUND_BODY, 404)
 
 @app.errorhandler(500)
 def internal_error(error):
     # Handle 500 errors 
-    return jsonify({
-        'success': False,
-        'message': 'Internal server error'
-    }), 500
+    return static_json_response(INTERNAL_ERROR_BODY, 500)
+
+# ASGI entry point (e.g. `uvicorn main:asgi_app`). Requests are accepted on a single
+# event loop and run on a fixed pool of worker threads instead of a new thread per
+# request. The pool has to be real: asgiref's WsgiToAsgi runs every request on one
+# shared thread, which would serialize polling behind pump commands and defeat the
+# emergency-stop preemption in SerialHandler.
+flask_asgi = WSGIMiddleware(app, workers=WSGI_WORKERS)
+
+async def static_not_found(request, exc):
+    # Keep the API's JSON 404 body for missing frontend assets
+    return Response(NOT_FOUND_BODY, status_code=404, media_type='application/json')
+
+# Static files (CSS, JS, images) are served by Starlette directly on the event loop,
+# with conditional-request handling, so they never reach a Flask worker. They skip
+# flask-cors too, so apply the same allow-all policy that CORS(app) uses.
+static_files = CORSMiddleware(
+    ExceptionMiddleware(
+        StaticFiles(directory=FRONTEND_DIR, check_dir=False),
+        handlers={404: static_not_found}
+    ),
+    allow_origins=['*'],
+    allow_methods=['*'],
+    allow_headers=['*']
+)
+
+async def asgi_app(scope, receive, send):
+    # Route / and /api/* to Flask; every other HTTP path is a frontend asset
+    path = scope.get('path', '')
+    if scope['type'] == 'http' and path != '/' and not path.startswith('/api/'):
+        await static_files(scope, receive, send)
+    else:
+        await flask_asgi(scope, receive, send)
 
 # Main function to start the Flask application 
 def main():
@@ -260,8 +328,7 @@ def main():
         print(" The web interface will still start, but pump control will not work.")
     
     # Check if frontend files exist
-    index_path = os.path.join(FRONTEND_DIR, 'index.html')
-    if not os.path.exists(index_path):
+    if INDEX_BYTES is None:
         print(f"Warning: Frontend files not found at {FRONTEND_DIR}")
         print(" Ensure the frontend files are in the correct directory.")
     else:
@@ -271,12 +338,12 @@ def main():
     print("   Press Ctrl+C to stop the server")
     
     try:
-        # Start Flask application
-        app.run(
+        # Start ASGI server
+        uvicorn.run(
+            asgi_app,
             host='0.0.0.0',  # Allow external connections
             port=DEFAULT_PORT,
-            debug=False,  # Set to True for development
-            threaded=True
+            log_level='info'
         )
     except KeyboardInterrupt:
         print("\n\n Server stopped by user")
@@ -1,44 +1,126 @@
 #!/usr/bin/env python3
 # Serial Handler module manages serial communication with Arduino for pump control.
+# Fully type-annotated so it can optionally be compiled with mypyc (see README).
 import serial
+import serial.threaded
 import serial.tools.list_ports
 import time
 import threading
 import logging
+import functools
+import itertools
+import queue
+import collections
+from concurrent.futures import Future, InvalidStateError, TimeoutError as FutureTimeoutError
+from typing import Deque, Dict, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+# How long a successful exchange with the Arduino counts as proof of a live connection
+CONNECTION_CACHE_SECONDS: float = 2.0
+
+# Upper bound on the Arduino bootloader's start-up time if opening the port resets the board
+ARDUINO_BOOT_SECONDS: float = 2.0
+
+# How long the reply to a discarded (timed-out) command is still expected before it's assumed lost
+LATE_REPLY_SECONDS: float = 1.0
+
+# Common Arduino identifiers, lowercased for matching against port descriptions
+ARDUINO_IDS: Tuple[str, ...] = tuple(identifier.lower() for identifier in (
+    'Arduino',
+    'CH340',  # Common USB-to-serial chip
+    'CP210',  # Silicon Labs USB-to-serial
+    'FT232',  # FTDI USB-to-serial
+    'USB Serial',
+    'ttyACM',  # Linux Arduino identifier
+    'ttyUSB',  # Linux USB serial identifier
+))
+
+# Command queue priorities; lower values are sent first
+PRIORITY_PREEMPT: int = 0
+PRIORITY_NORMAL: int = 1
+
+# Pre-encoded command used to probe the connection
+_STATUS_CMD: bytes = b"STATUS\n"
+
+@functools.lru_cache(maxsize=64)
+def _encode(command: str) -> bytes:
+    # Commands repeat (STATUS, EMERGENCY, STOP,X...), so cache their wire format
+    return (command + '\n').encode('ascii')
+
+class _PendingCommand:
+    # Reply being collected for the command currently on the wire
+    def __init__(self, command: str) -> None:
+        self.command = command
+        self.lines: List[str] = []
+        self.skipped_reply = False  # A late reply to an earlier command arrived while this was pending
+        self.future: "Future[str]" = Future()
+    
+    def resolve(self, response: str) -> None:
+        # Called from the reader thread only; a command that already has its reply keeps it
+        try:
+            self.future.set_result(response)
+        except InvalidStateError:
+            pass
+
+class _ArduinoLineReader(serial.threaded.LineReader):
+    # Protocol run by pyserial's ReaderThread, which reads everything the UART has
+    # buffered in one call; each complete newline-terminated line goes to the handler
+    TERMINATOR = b'\n'
+    
+    def __init__(self, handler: "SerialHandler") -> None:
+        super().__init__()
+        self.handler = handler
+    
+    def handle_line(self, line: str) -> None:
+        self.handler._handle_line(line)
+    
+    def connection_lost(self, exc: Optional[BaseException]) -> None:
+        # Don't re-raise on the reader thread, just fail the waiting command
+        self.transport = None
+        self.handler._handle_connection_lost(exc)
+
 class SerialHandler:
-    def __init__(self, baudrate=9600, timeout=2):
+    def __init__(self, baudrate: int = 115200, timeout: float = 0.1) -> None:
         self.baudrate = baudrate
         self.timeout = timeout
-        self.serial_connection = None
-        self.port = None
-        self.lock = threading.Lock()  
+        self.serial_connection: Optional[serial.Serial] = None
+        self.port: Optional[str] = None
+        self._io_lock = threading.Lock()  # Guards reads/writes on the open port
+        self._state_lock = threading.Lock()  # Guards opening, closing and replacing the port
+        self._reader: "Optional[serial.threaded.ReaderThread[_ArduinoLineReader]]" = None  # Frames replies from the port
+        self._pending: Optional[_PendingCommand] = None  # Command awaiting (or draining) its reply
+        self._owed_replies: Deque[float] = collections.deque()  # Deadlines for replies to discarded commands
+        self._last_ok = 0.0  # time.monotonic() of the last non-error reply to a command
+        self._last_port: Optional[str] = None  # Last port that connected successfully, kept across disconnects
+        
+        # Commands are executed one at a time by a single worker thread, in
+        # (priority, submission order); callers wait on a Future for the response
+        self._queue: "queue.PriorityQueue[Tuple[int, int, str, Future[str]]]" = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._worker = threading.Thread(target=self._run_worker, name="serial-worker", daemon=True)
+        self._worker.start()
+        
+        # STATUS requests that arrive while one is already queued share its Future
+        self._status_lock = threading.Lock()
+        self._status_inflight: Optional["Future[str]"] = None
+        
+    def find_arduino_port(self) -> Optional[str]:
+        # Try the last working port first so reconnects don't re-enumerate every device
+        if self._last_port:
+            logger.info("Trying last known Arduino port: %s", self._last_port)
+            return self._last_port
         
-    def find_arduino_port(self):
         logger.info("Scanning for Arduino...")
         ports = serial.tools.list_ports.comports()
-        # Common Arduino identifiers
-        arduino_identifiers = [
-            'Arduino',
-            'CH340',  # Common USB-to-serial chip
-            'CP210',  # Silicon Labs USB-to-serial
-            'FT232',  # FTDI USB-to-serial
-            'USB Serial',
-            'ttyACM',  # Linux Arduino identifier
-            'ttyUSB',  # Linux USB serial identifier
-        ]
         
         for port in ports:
-            port_info = f"{port.device} - {port.description} - {port.manufacturer}"
-            logger.debug(f"Found port: {port_info}")
+            logger.debug("Found port: %s - %s - %s", port.device, port.description, port.manufacturer)
 
-            for identifier in arduino_identifiers:
-                if identifier.lower() in port.description.lower() or \
-                   (port.manufacturer and identifier.lower() in port.manufacturer.lower()):
-                    logger.info(f"Arduino found on port: {port.device}")
-                    return port.device
+            hay = f"{port.description} {port.manufacturer or ''}".lower()
+            if any(identifier in hay for identifier in ARDUINO_IDS):
+                logger.info("Arduino found on port: %s", port.device)
+                return port.device
         
         # If no Arduino-specific port found, try common port names
         common_ports = [
@@ -56,17 +138,18 @@ class SerialHandler:
         
         for port_name in common_ports:
             if any(port.device == port_name for port in ports):
-                logger.info(f"Trying common Arduino port: {port_name}")
+                logger.info("Trying common Arduino port: %s", port_name)
                 return port_name
         
         logger.warning("No Arduino port found automatically")
         return None
     
-    def connect(self, port=None):
-        with self.lock:
+    def connect(self, port: Optional[str] = None) -> bool:
+        with self._state_lock:
             try:
                 if self.serial_connection and self.serial_connection.is_open:
-                    self.disconnect()
+                    with self._io_lock:
+                        self._close()
                 
                 if port is None:
                     port = self.find_arduino_port()
@@ -75,141 +158,273 @@ class SerialHandler:
                         return False
                 
                 # Attempt to connect
-                logger.info(f"Attempting to connect to Arduino on {port}")
-                self.serial_connection = serial.Serial(
-                    port=port,
-                    baudrate=self.baudrate,
-                    timeout=self.timeout,
-                    write_timeout=self.timeout
-                )
+                logger.info("Attempting to connect to Arduino on %s", port)
+                # Keep DTR/RTS low while opening so the Arduino isn't auto-reset
+                connection = serial.Serial()
+                connection.port = port
+                connection.baudrate = self.baudrate
+                connection.timeout = self.timeout
+                connection.write_timeout = self.timeout
+                connection.dtr = False
+                connection.rts = False
+                connection.open()
                 
-                # Wait for Arduino to initialize
-                time.sleep(2)
+                # Bypass the USB-serial driver latency timer (Linux only, ~16 ms by default)
+                try:
+                    connection.set_low_latency_mode(True)
+                except (AttributeError, NotImplementedError, ValueError, OSError) as e:
+                    logger.debug("Low latency mode not available: %s", e)
                 
-                # Test connection by sending a status request
-                if self.test_connection():
-                    self.port = port
-                    logger.info(f"Successfully connected to Arduino on {port}")
-                    return True
-                else:
+                reader = serial.threaded.ReaderThread(connection, lambda: _ArduinoLineReader(self))
+                reader.start()
+                reader.connect()
+                
+                # Swap in the new port and test it by sending a status request. If the board
+                # reset anyway (e.g. some drivers raise DTR on open), keep probing until the
+                # sketch is up instead of always sleeping for the bootloader.
+                with self._io_lock:
+                    self.serial_connection = connection
+                    self._reader = reader
+                    connected = self._probe_until_ready()
+                    if not connected:
+                        # Native-USB boards (Leonardo/Micro) drop CDC data while DTR is low,
+                        # so raise it and give the board another boot window
+                        logger.info("No reply with DTR low on %s, retrying with DTR high", port)
+                        connection.dtr = True
+                        connected = self._probe_until_ready()
+                    
+                    if connected:
+                        self.port = port
+                        self._last_port = port
+                        logger.info("Successfully connected to Arduino on %s", port)
+                        return True
+                    
                     logger.error("Arduino not responding to test command")
-                    self.disconnect()
+                    self._last_port = None  # Rescan on the next attempt
+                    self._close()
                     return False
                     
             except serial.SerialException as e:
-                logger.error(f"Serial connection error: {e}")
+                logger.error("Serial connection error: %s", e)
+                self._last_port = None  # Rescan on the next attempt
                 return False
             except Exception as e:
-                logger.error(f"Unexpected error connecting to Arduino: {e}")
+                logger.error("Unexpected error connecting to Arduino: %s", e)
+                self._last_port = None
                 return False
     
-    def disconnect(self):
+    def _probe_until_ready(self) -> bool:
+        # Caller must hold _io_lock. Re-send STATUS until the sketch answers or the
+        # bootloader window has passed.
+        deadline = time.monotonic() + ARDUINO_BOOT_SECONDS
+        connected = self.test_connection()
+        while not connected and time.monotonic() < deadline:
+            connected = self.test_connection()
+        return connected
+    
+    def disconnect(self) -> None:
 
-        with self.lock:
-            if self.serial_connection and self.serial_connection.is_open:
-                try:
+        with self._state_lock, self._io_lock:
+            self._close()
+    
+    def _close(self) -> None:
+        # Caller must hold both _state_lock and _io_lock
+        if self.serial_connection and self.serial_connection.is_open:
+            try:
+                if self._reader is not None:
+                    self._reader.close()  # Stops the reader thread, then closes the port
+                else:
                     self.serial_connection.close()
-                    logger.info("Disconnected from Arduino")
-                except Exception as e:
-                    logger.error(f"Error disconnecting: {e}")
-            
-            self.serial_connection = None
-            self.port = None
+                logger.info("Disconnected from Arduino")
+            except Exception as e:
+                logger.error("Error disconnecting: %s", e)
+        
+        self.serial_connection = None
+        self._reader = None
+        self._pending = None
+        self._owed_replies.clear()
+        self.port = None
+        self._last_ok = 0.0
     
-    def is_connected(self):
-        with self.lock:
+    def is_connected(self) -> bool:
+        # A recent response proves the link without taking the lock or writing to the port
+        connection = self.serial_connection
+        reader = self._reader
+        if connection and connection.is_open and reader is not None and reader.alive and \
+           time.monotonic() - self._last_ok < CONNECTION_CACHE_SECONDS:
+            return True
+        
+        with self._io_lock:
             if not self.serial_connection or not self.serial_connection.is_open:
                 return False
             
             return self.test_connection()
     
-    def test_connection(self):
+    def test_connection(self) -> bool:
+        # Caller must hold _io_lock; a silent board is an expected outcome here, so don't log it
+        response = self._exchange("STATUS", _STATUS_CMD, log_timeout=False)
+        return response.startswith('{') and response.endswith('}')
+    
+    def _handle_line(self, line: str) -> None:
+        # Runs on the reader thread for every line received from the Arduino
+        line = line.strip()
+        if not line:  # Skip empty lines
+            return
+        
+        # Every command ends with exactly one of these: OK, ERROR..., or the STATUS JSON
+        is_json = line.startswith('{') and line.endswith('}')
+        is_error = line.startswith("ERROR")
+        pending = self._pending
+        if (is_error or line == "OK") and self._consume_owed_reply():
+            logger.debug("Skipping late reply to a discarded command: %s", line)
+            if pending is not None:
+                pending.skipped_reply = True
+            return
+        
+        if pending is None or pending.future.done():
+            logger.debug("Ignoring unsolicited line: %s", line)
+            return
+        
+        logger.debug("Received line: %s", line)
+        pending.lines.append(line)
+        
+        # For STATUS command, look for JSON response; for other commands, look for OK or ERROR
+        if is_error or (is_json if pending.command == "STATUS" else line == "OK"):
+            if not is_error:
+                self._last_ok = time.monotonic()
+            pending.resolve(line)
+    
+    def _consume_owed_reply(self) -> bool:
+        # Runs on the reader thread: True if an OK/ERROR belongs to a discarded command.
+        # The board answers in order, so the oldest owed reply that hasn't expired is it.
+        now = time.monotonic()
+        owed = self._owed_replies
+        while owed:
+            if owed.popleft() >= now:
+                return True
+        return False
+    
+    def _handle_connection_lost(self, exc: Optional[BaseException]) -> None:
+        # Runs on the reader thread when it stops, e.g. after a USB disconnect
+        if exc is not None:
+            logger.error("Serial connection lost: %s", exc)
+        
+        self._last_ok = 0.0  # Don't let is_connected() vouch for a dead link
+        pending = self._pending
+        if pending is not None:
+            pending.resolve(f"ERROR: Serial error - {exc}")
+    
+    def submit_command(self, command: str, preempt: bool = False) -> "Future[str]":
+        # Queue a command for the worker thread and return a Future for its response.
+        # With preempt=True (e.g. emergency stop) the command jumps the queue; the
+        # command already on the wire still gets its reply, which takes milliseconds.
+        priority = PRIORITY_PREEMPT if preempt else PRIORITY_NORMAL
+        future: "Future[str]" = Future()
+        self._queue.put((priority, next(self._sequence), command, future))
+        return future
+    
+    def send_command(self, command: str, preempt: bool = False) -> str:
+        return self.submit_command(command, preempt).result()
+    
+    def get_status(self) -> str:
+        # Concurrent pollers share a single STATUS round trip instead of queueing one each
+        with self._status_lock:
+            inflight = self._status_inflight
+            is_new = inflight is None
+            future = self.submit_command("STATUS") if inflight is None else inflight
+            self._status_inflight = future
+        
+        # Registered outside the lock: the callback runs immediately if already done
+        if is_new:
+            future.add_done_callback(self._clear_status_inflight)
+        return future.result()
+    
+    def _clear_status_inflight(self, future: "Future[str]") -> None:
+        with self._status_lock:
+            if self._status_inflight is future:
+                self._status_inflight = None
+    
+    def _run_worker(self) -> None:
+        while True:
+            _, _, command, future = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            
+            try:
+                with self._io_lock:
+                    response = self._execute_command(command)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(response)
+    
+    def _execute_command(self, command: str) -> str:
+        # Runs on the worker thread with _io_lock held
+        return self._exchange(command, _encode(command))
+    
+    def _exchange(self, command: str, payload: bytes, log_timeout: bool = True) -> str:
+        # Write one command and wait for the reader thread to deliver its reply.
+        # Caller must hold _io_lock.
+        reader = self._reader
+        if reader is None or not reader.alive or \
+           not self.serial_connection or not self.serial_connection.is_open:
+            logger.error("Arduino not connected")
+            return "ERROR: Arduino not connected"
+        
+        # Replies carry no sequence number. If the previous command timed out, give its
+        # late reply a chance to arrive so it isn't taken as the answer to this one.
+        previous = self._pending
+        if previous is not None:
+            try:
+                previous.future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                logger.debug("No reply to command %s, discarding it", previous.command)
+                # A late STATUS reply is JSON, which can only ever answer another STATUS, so
+                # only other commands owe an OK/ERROR. If one was skipped while `previous`
+                # waited, an earlier reply was most likely lost and the skipped one was its own.
+                if previous.command != "STATUS" and not previous.skipped_reply:
+                    self._owed_replies.append(time.monotonic() + LATE_REPLY_SECONDS)
+        
+        pending = _PendingCommand(command)
+        self._pending = pending
         try:
-            # Clear any pending data
-            if self.serial_connection.in_waiting > 0:
-                self.serial_connection.read_all()
+            reader.write(payload)
+            logger.debug("Sent command: %s", command)
             
-            # Send test command
-            self.serial_connection.write(b"STATUS\n")
-            self.serial_connection.flush()
+            try:
+                response = pending.future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                pass  # Leave it pending so its reply is drained before the next command
+            else:
+                self._pending = None
+                return response
             
-            # Wait for response
-            start_time = time.time()
-            while time.time() - start_time < self.timeout:
-                if self.serial_connection.in_waiting > 0:
-                    response = self.serial_connection.readline().decode('utf-8').strip()
-                    if response.startswith('{') and response.endswith('}'):
-                        return True
-                time.sleep(0.1)
+            # If we got some response but not the expected format, return the last line
+            if pending.lines:
+                return pending.lines[-1]
             
-            return False
+            if log_timeout:
+                logger.error("Timeout waiting for response to command: %s", command)
+            return "ERROR: Timeout"
             
+        except serial.SerialException as e:
+            self._pending = None
+            self._last_ok = 0.0
+            logger.error("Serial error sending command '%s': %s", command, e)
+            return f"ERROR: Serial error - {e}"
         except Exception as e:
-            logger.error(f"Error testing connection: {e}")
-            return False
-    
-    def send_command(self, command):
- 
-        with self.lock:
-            if not self.serial_connection or not self.serial_connection.is_open:
-                logger.error("Arduino not connected")
-                return "ERROR: Arduino not connected"
-            
-            try:
-                # Clear any pending input
-                if self.serial_connection.in_waiting > 0:
-                    self.serial_connection.read_all()
-                
-                # Send command with proper formatting
-                command_bytes = (command + '\n').encode('utf-8')
-                self.serial_connection.write(command_bytes)
-                self.serial_connection.flush()
-                
-                logger.debug(f"Sent command: {command}")
-                
-                # Wait for response - read multiple lines if needed
-                response_lines = []
-                start_time = time.time()
-                
-                while time.time() - start_time < self.timeout:
-                    if self.serial_connection.in_waiting > 0:
-                        line = self.serial_connection.readline().decode('utf-8').strip()
-                        if line:  # Skip empty lines
-                            logger.debug(f"Received line: {line}")
-                            response_lines.append(line)
-                            
-                            # For STATUS command, look for JSON response
-                            if command == "STATUS" and line.startswith('{') and line.endswith('}'):
-                                return line
-                            
-                            # For other commands, look for OK or ERROR
-                            if line == "OK" or line.startswith("ERROR"):
-                                return line
-                    
-                    time.sleep(0.05)  # Small delay to prevent busy waiting
-                
-                # If we got some response but not the expected format, return the last line
-                if response_lines:
-                    return response_lines[-1]
-                
-                logger.error(f"Timeout waiting for response to command: {command}")
-                return "ERROR: Timeout"
-                
-            except serial.SerialException as e:
-                logger.error(f"Serial error sending command '{command}': {e}")
-                return f"ERROR: Serial error - {e}"
-            except Exception as e:
-                logger.error(f"Unexpected error sending command '{command}': {e}")
-                return f"ERROR: {e}"
+            self._pending = None
+            logger.error("Unexpected error sending command '%s': %s", command, e)
+            return f"ERROR: {e}"
     
-    def get_port_info(self):
+    def get_port_info(self) -> str:
         if self.port:
             return self.port
         return "Not connected"
     
-    def list_available_ports(self):
+    def list_available_ports(self) -> List[Dict[str, str]]:
         ports = serial.tools.list_ports.comports()
-        port_list = []
+        port_list: List[Dict[str, str]] = []
         
         for port in ports:
             port_info = {
@@ -221,7 +436,7 @@ class SerialHandler:
         
         return port_list
     
-    def reconnect(self):
+    def reconnect(self) -> bool:
         logger.info("Attempting to reconnect to Arduino...")
         self.disconnect()
         time.sleep(1)  # Brief delay before reconnecting